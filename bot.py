@@ -1,48 +1,226 @@
 import os
-import io
-from datetime import datetime
+import asyncio
+import calendar
+import csv
+import logging
+import math
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from array import array
+from functools import lru_cache
+from heapq import nlargest
+from operator import itemgetter
 
+import xlsxwriter
 from telegram import Update, InputFile
-from telegram.ext import Application, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, ContextTypes, filters
+try:
+    import uvloop          # optional: faster event loop on Linux/macOS
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger(__name__)
 
 # =============== Config ===============
 TOKEN = os.getenv("BOT_TOKEN")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")   # e.g. https://<app>.up.railway.app
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None   # 1-256 chars of A-Z a-z 0-9 _ -
+PORT = int(os.getenv("PORT", "8443"))
+DB_PATH = os.getenv("DB_PATH", "bw.db")
 
 # =============== App State ===============
-# STORE[user_id][period] = [ {amount, category, notes, ts}, ... ]
-STORE = {}
+# Expenses live in SQLite: expenses(user_id, period, ts, amount, category, notes)
+# MODE/CURRENT_PERIOD are read from RAM and written through to user_state.
 MODE = {}                 # user_id -> "add" or None
 CURRENT_PERIOD = {}       # user_id -> "YYYY-MM"
+TOTALS = {}               # (user_id, period) -> CategoryTotals, kept in step with inserts
+VERSION = {}              # user_id -> counter bumped on every change to that user's expenses
+EXPORT_CACHE = {}         # user_id -> (period, version, Telegram file_id of the last .xlsx sent), least recent first
+EXPORT_CACHE_MAX = 1024
+SUMMARY_CACHE = {}        # (kind, user_id, period, version) -> rendered view/generate reply
+SUMMARY_CACHE_MAX = 1024
+
+def _connect() -> sqlite3.Connection:
+    if DB_PATH == ":memory:":
+        # plain ":memory:" gives every connection its own empty database; a named
+        # shared-cache one lets the export threads see the tables DB created
+        return sqlite3.connect("file:budget_wizard?mode=memory&cache=shared", uri=True, check_same_thread=False)
+    return sqlite3.connect(DB_PATH, check_same_thread=False)
+
+def _open_db() -> sqlite3.Connection:
+    conn = _connect()
+    # WAL + NORMAL: durable across restarts without an fsync per insert
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS expenses (
+            user_id  INTEGER NOT NULL,
+            period   TEXT    NOT NULL,
+            ts       INTEGER NOT NULL,   -- epoch seconds, UTC
+            amount   REAL    NOT NULL,
+            category TEXT    NOT NULL,
+            notes    TEXT    NOT NULL DEFAULT ''
+        );
+        CREATE INDEX IF NOT EXISTS idx_expenses_user_period ON expenses(user_id, period);
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            mode    TEXT,
+            period  TEXT
+        );
+    """)
+    return conn
+
+DB = _open_db()
+
+def _load_user_state():
+    for user_id, mode, period in DB.execute("SELECT user_id, mode, period FROM user_state"):
+        MODE[user_id] = mode
+        if period:
+            CURRENT_PERIOD[user_id] = period
+
+_load_user_state()
+
+def set_mode(user_id: int, mode):
+    MODE[user_id] = mode
+    with DB:
+        DB.execute(
+            "INSERT INTO user_state (user_id, mode) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET mode = excluded.mode",
+            (user_id, mode),
+        )
+
+def set_period(user_id: int, period: str):
+    CURRENT_PERIOD[user_id] = period
+    with DB:
+        DB.execute(
+            "INSERT INTO user_state (user_id, period) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET period = excluded.period",
+            (user_id, period),
+        )
+
+_MONTH_CACHE = [0.0, ""]  # [valid until (epoch s), "YYYY-MM"]
 
 def _this_month() -> str:
-    return datetime.utcnow().strftime("%Y-%m")
+    # re-derived only when the UTC month rolls over, so the common case is one time() call
+    now = time.time()
+    if now >= _MONTH_CACHE[0]:
+        tm = time.gmtime(now)
+        year, month = tm.tm_year + tm.tm_mon // 12, tm.tm_mon % 12 + 1
+        _MONTH_CACHE[:] = [calendar.timegm((year, month, 1, 0, 0, 0)), time.strftime("%Y-%m", tm)]
+    return _MONTH_CACHE[1]
 
 def _ensure_user_period(user_id: int) -> str:
     period = CURRENT_PERIOD.get(user_id)
     if not period:
         period = _this_month()
-        CURRENT_PERIOD[user_id] = period
-    STORE.setdefault(user_id, {}).setdefault(period, [])
+        set_period(user_id, period)
     return period
 
-def add_expense_to_store(user_id: int, amount: float, category: str, notes: str):
+class CategoryTotals:
+    """
+    Running per-category totals for one period, dictionary-encoded:
+    each category gets a small int id and its total lives at totals[id].
+    """
+    __slots__ = ("cats", "cat_idx", "totals")
+
+    def __init__(self, rows=()):
+        self.cats = []        # id -> category
+        self.cat_idx = {}     # category -> id
+        self.totals = array("d")   # id -> total, packed C doubles
+        for category, amount in rows:
+            self.add(category, amount)
+
+    def add(self, category: str, amount: float):
+        cid = self.cat_idx.get(category)
+        if cid is None:
+            cid = self.cat_idx[category] = len(self.cats)
+            self.cats.append(category)
+            self.totals.append(0.0)
+        self.totals[cid] += amount
+
+    def items(self):
+        return zip(self.cats, self.totals)
+
+def _period_totals(user_id: int, period: str) -> CategoryTotals:
+    """Running totals for a period; seeded from SQLite the first time it's read."""
+    by_cat = TOTALS.get((user_id, period))
+    if by_cat is None:
+        rows = DB.execute(
+            "SELECT category, SUM(amount) FROM expenses WHERE user_id = ? AND period = ? GROUP BY category",
+            (user_id, period),
+        ).fetchall()
+        by_cat = TOTALS[user_id, period] = CategoryTotals(rows)
+    return by_cat
+
+def add_expenses_to_store(user_id: int, items, ts: int = None):
+    """Insert [(amount, category, notes), ...] in one transaction, all stamped with ts."""
+    if not items:
+        return
     period = _ensure_user_period(user_id)
-    STORE[user_id][period].append({
-        "amount": amount,
-        "category": category,
-        "notes": notes,
-        "ts": datetime.utcnow()
-    })
+    by_cat = _period_totals(user_id, period)
+    if ts is None:
+        ts = int(time.time())
+    with DB:
+        DB.executemany(
+            "INSERT INTO expenses (user_id, period, ts, amount, category, notes) VALUES (?, ?, ?, ?, ?, ?)",
+            [(user_id, period, ts, amount, category, notes) for amount, category, notes in items],
+        )
+    for amount, category, _ in items:
+        by_cat.add(category, amount)
+    VERSION[user_id] = VERSION.get(user_id, 0) + 1
+
+def add_expense_to_store(user_id: int, amount: float, category: str, notes: str, ts: int = None):
+    add_expenses_to_store(user_id, [(amount, category, notes)], ts)
 
 def clear_current_month(user_id: int):
     period = _ensure_user_period(user_id)
-    STORE[user_id][period] = []
+    with DB:
+        DB.execute("DELETE FROM expenses WHERE user_id = ? AND period = ?", (user_id, period))
+    TOTALS[user_id, period] = CategoryTotals()
+    VERSION[user_id] = VERSION.get(user_id, 0) + 1
+
+def get_expenses(conn: sqlite3.Connection, user_id: int, period: str):
+    """Cursor over plain (ts, amount, category, notes) tuples, oldest first."""
+    return conn.execute(
+        "SELECT ts, amount, category, notes FROM expenses WHERE user_id = ? AND period = ? ORDER BY rowid",
+        (user_id, period),
+    )
 
-def get_current_month_expenses(user_id: int):
+TOP_CATEGORIES = 20       # categories listed in view/generate replies
+
+def get_current_month_summary(user_id: int):
+    """(total, top [(category, total), ...] largest first, number of categories) for the current period."""
     period = _ensure_user_period(user_id)
-    return STORE[user_id][period]
+    by_cat = _period_totals(user_id, period)
+    # fsum over the per-category totals: O(#categories) and no float drift across many adds
+    total = math.fsum(by_cat.totals)
+    return total, nlargest(TOP_CATEGORIES, by_cat.items(), key=itemgetter(1)), len(by_cat.cats)
 
 # =============== Parsing helpers ===============
+STOPWORDS = frozenset({"for", "on", "to", "the", "a", "an", "my"})
+STRIP_MONEY = str.maketrans("", "", "$,")   # drops "$" and thousands separators in one pass
+# amount token (checked by float() below), leading stopwords, category, notes
+EXPENSE_RE = re.compile(
+    r"\s*(\S+)"
+    r"(?:\s+(?:(?:" + "|".join(sorted(STOPWORDS)) + r")(?:\s+|$))*(\S+)?(?:\s+(.*))?)?$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+def parse_amount(token: str):
+    """
+    Amount as a plain float() after dropping "$" and ",": "-20", "1e3", "50$", ",50".
+    Returns None for anything else, including "nan"/"inf", which SQLite can't
+    store (NaN becomes NULL) and which would poison every total they touch.
+    """
+    try:
+        amt = float(token.translate(STRIP_MONEY))
+    except ValueError:
+        return None
+    return amt if math.isfinite(amt) else None
+
 def parse_free_expense(text: str):
     """
     Accepts a single line like:
@@ -50,22 +228,24 @@ def parse_free_expense(text: str):
       "$50 groceries milk"
     Returns (amount, category, notes) or None.
     """
-    parts = text.strip().split()
-    if not parts:
+    m = EXPENSE_RE.match(text)
+    if not m:
         return None
-    first = parts[0].replace("$", "").replace(",", "")
-    try:
-        amt = float(first)
-    except ValueError:
+    amt = parse_amount(m.group(1))
+    if amt is None:
         return None
-    tokens = parts[1:]
-    stopwords = {"for", "on", "to", "the", "a", "an", "my"}
-    while tokens and tokens[0].lower() in stopwords:
-        tokens = tokens[1:]
-    cat = tokens[0] if tokens else "uncategorized"
-    notes = " ".join(tokens[1:]) if len(tokens) > 1 else ""
+    # lowercased and interned: "Rent" and "rent" land in one category, and repeats
+    # share one str so dict lookups hit the identity fast path
+    cat = sys.intern(m.group(2).lower()) if m.group(2) else "uncategorized"
+    # notes is greedy to the end of the line (a lazy group rescans long whitespace runs);
+    # runs of whitespace inside it collapse to single spaces
+    notes = " ".join(m.group(3).split()) if m.group(3) else ""
     return amt, cat, notes
 
+# bound the work a single pasted message can put on the event loop
+MAX_BLOCK_CHARS = 64_000
+MAX_BLOCK_LINES = 2000
+
 def parse_expense_block(text: str):
     """
     Accept multiple expenses separated by newlines OR slashes.
@@ -76,40 +256,74 @@ def parse_expense_block(text: str):
     or:
       1200 rent / 500 food / 200 insurance
     """
+    if len(text) > MAX_BLOCK_CHARS:
+        return [], ["<input too large>"]
     if ("\n" not in text) and ("/" in text):
         lines = [p.strip() for p in text.split("/") if p.strip()]
     else:
         lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    overflow = len(lines) - MAX_BLOCK_LINES
+    if overflow > 0:
+        lines = lines[:MAX_BLOCK_LINES]
 
     items, errors = [], []
+    # bound once: the loop runs up to MAX_BLOCK_LINES times per message
+    parse, add_item, add_error = parse_free_expense, items.append, errors.append
     for raw in lines:
-        parsed = parse_free_expense(raw)
+        parsed = parse(raw)
         if parsed:
-            items.append(parsed)
+            add_item(parsed)
         else:
-            errors.append(raw)
+            add_error(raw)
+    if overflow > 0:
+        errors.append(f"<{overflow} line(s) past the {MAX_BLOCK_LINES}-line limit>")
     return items, errors
 
+def _format_add_result(n_items: int, errors: list) -> str:
+    """Reply text for a batch add: the count, plus the first few skipped lines."""
+    parts = [f"✅ Added {n_items} item(s)."]
+    if errors:
+        parts.append(f"⚠️ Skipped {len(errors)} line(s):")
+        parts.extend(f"- {e}" for e in errors[:5])
+        if len(errors) > 5:
+            parts.append(f"(and {len(errors)-5} more...)")
+    return "\n".join(parts)
+
+# the entries parse_expense_block adds when a paste hits MAX_BLOCK_CHARS / MAX_BLOCK_LINES (always last)
+LIMIT_ERROR_RE = re.compile(r"<(?:input too large|\d+ line\(s\) past the \d+-line limit)>")
+
+def _nothing_added_reply(usage: str, errors: list) -> str:
+    """Reply for a paste that added nothing: the usage hint, led by the size limit it hit, if any."""
+    if errors and LIMIT_ERROR_RE.fullmatch(errors[-1]):
+        return f"⚠️ Nothing added: {errors[-1]}\n\n{usage}"
+    return usage
+
 # =============== Telegram Commands ===============
+WELCOME_TEXT = (
+    "Welcome to Budget Wizard 🧙‍♂️\n"
+    "Enter **monthly** expenses like:\n"
+    "• 1200 rent\n• 60 phone\n• 230 car_insurance\n\n"
+    "Paste multiple lines or use slashes: 1200 rent / 500 food / 200 insurance\n"
+    "Shortcuts: **view**, **generate**, **export**, **csv**, **done**.\n"
+    "Type **reset** to start a new month."
+)
+ADDMANY_USAGE = (
+    "Paste multiple lines after the command, e.g.:\n"
+    "/addmany\n1200 rent\n500 groceries\n200 gas\n\n"
+    "You can also separate with slashes: 1200 rent / 500 food / 200 insurance"
+)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    CURRENT_PERIOD[user_id] = _this_month()
-    MODE[user_id] = "add"
-    _ensure_user_period(user_id)
-    await update.message.reply_text(
-        "Welcome to Budget Wizard 🧙‍♂️\n"
-        "Enter **monthly** expenses like:\n"
-        "• 1200 rent\n• 60 phone\n• 230 car_insurance\n\n"
-        "Paste multiple lines or use slashes: 1200 rent / 500 food / 200 insurance\n"
-        "Shortcuts: **view**, **generate**, **export**, **done**.\n"
-        "Type **reset** to start a new month."
-    )
+    set_period(user_id, _this_month())
+    set_mode(user_id, "add")
+    await update.message.reply_text(WELCOME_TEXT)
 
 async def reset_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    CURRENT_PERIOD[user_id] = _this_month()
+    set_period(user_id, _this_month())
     clear_current_month(user_id)
-    MODE[user_id] = "add"
+    set_mode(user_id, "add")
     await update.message.reply_text("✅ Cleared this month's expenses. Add new items now.")
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -118,11 +332,10 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def addexpense(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args or len(context.args) < 2:
         return await update.message.reply_text("Usage: /addexpense <amount> <category> [notes]")
-    try:
-        amount = float(context.args[0].replace(",", ""))
-    except ValueError:
+    amount = parse_amount(context.args[0])
+    if amount is None:
         return await update.message.reply_text("Amount must be a number.")
-    category = context.args[1]
+    category = sys.intern(context.args[1].lower())
     notes = " ".join(context.args[2:]) if len(context.args) > 2 else ""
     user_id = update.effective_user.id
     add_expense_to_store(user_id, amount, category, notes)
@@ -136,160 +349,315 @@ async def addmany(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = update.message.text
     block = text.split("\n", 1)[1] if "\n" in text else ""
     if not block.strip():
-        return await update.message.reply_text(
-            "Paste multiple lines after the command, e.g.:\n"
-            "/addmany\n1200 rent\n500 groceries\n200 gas\n\n"
-            "You can also separate with slashes: 1200 rent / 500 food / 200 insurance"
-        )
+        return await update.message.reply_text(ADDMANY_USAGE)
     user_id = update.effective_user.id
     items, errors = parse_expense_block(block)
-    for amt, cat, notes in items:
-        add_expense_to_store(user_id, amt, cat, notes)
-    msg = f"✅ Added {len(items)} item(s)."
-    if errors:
-        msg += f"\n⚠️ Skipped {len(errors)} line(s):\n- " + "\n- ".join(errors[:5])
-        if len(errors) > 5:
-            msg += f"\n(and {len(errors)-5} more...)"
-    await update.message.reply_text(msg)
+    add_expenses_to_store(user_id, items)
+    await update.message.reply_text(_format_add_result(len(items), errors))
+
+def _cached_summary(kind: str, user_id: int, render) -> str:
+    """Reply text for view/generate, re-rendered only after the user's expenses change."""
+    period = _ensure_user_period(user_id)
+    key = (kind, user_id, period, VERSION.get(user_id, 0))
+    text = SUMMARY_CACHE.get(key)
+    if text is None:
+        text = render(user_id, period)
+        if len(SUMMARY_CACHE) >= SUMMARY_CACHE_MAX:
+            SUMMARY_CACHE.pop(next(iter(SUMMARY_CACHE)))   # oldest entry first
+        SUMMARY_CACHE[key] = text
+    return text
+
+def _render_view(user_id: int, period: str) -> str:
+    total, by_cat, n_cats = get_current_month_summary(user_id)
+    if not by_cat:
+        return "No expenses yet."
+    lines = [f"📊 {period} total: ${total:.2f}"]
+    for k, v in by_cat:
+        lines.append(f"- {k}: ${v:.2f}")
+    if n_cats > len(by_cat):
+        lines.append(f"(and {n_cats - len(by_cat)} more categories)")
+    return "\n".join(lines)
+
+def _render_budget(user_id: int, period: str) -> str:
+    monthly_total, by_cat, n_cats = get_current_month_summary(user_id)
+    if not by_cat:
+        return "No data yet."
+    lines = [f"📅 Budget ({period}):", f"Total: ${monthly_total:.2f}", ""]
+    for k, v in by_cat:
+        lines.append(f"• {k}: ${v:.2f}")
+    if n_cats > len(by_cat):
+        lines.append(f"(and {n_cats - len(by_cat)} more categories)")
+    return "\n".join(lines)
 
 async def viewexpenses(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        items = get_current_month_expenses(user_id)
-        if not items:
-            return await update.message.reply_text("No expenses yet.")
-        total = sum(x["amount"] for x in items)
-        by_cat = {}
-        for x in items:
-            by_cat[x["category"]] = by_cat.get(x["category"], 0) + x["amount"]
-        period = CURRENT_PERIOD[user_id]
-        lines = [f"📊 {period} total: ${total:.2f}"]
-        for k, v in sorted(by_cat.items(), key=lambda kv: -kv[1]):
-            lines.append(f"- {k}: ${v:.2f}")
-        await update.message.reply_text("\n".join(lines))
+        await update.message.reply_text(_cached_summary("view", user_id, _render_view))
     except Exception as e:
         await update.message.reply_text(f"❌ view error: {e}")
 
 async def generatebudget(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = update.effective_user.id
-        items = get_current_month_expenses(user_id)
-        if not items:
-            return await update.message.reply_text("No data yet.")
-        monthly_total = sum(x["amount"] for x in items)
-        by_cat = {}
-        for x in items:
-            by_cat[x["category"]] = by_cat.get(x["category"], 0) + x["amount"]
-        period = CURRENT_PERIOD[user_id]
-        lines = [f"📅 Budget ({period}):", f"Total: ${monthly_total:.2f}", ""]
-        for k, v in sorted(by_cat.items(), key=lambda kv: -kv[1]):
-            lines.append(f"• {k}: ${v:.2f}")
-        await update.message.reply_text("\n".join(lines))
+        await update.message.reply_text(_cached_summary("generate", user_id, _render_budget))
     except Exception as e:
         await update.message.reply_text(f"❌ generate error: {e}")
 
+EXCEL_EPOCH_DAYS = 25569   # 1970-01-01 as an Excel serial day
+EXPORT_HEADER = ("Period", "Timestamp (UTC)", "Amount", "Category", "Notes")
+# format properties shared by every export; xlsxwriter formats belong to one workbook,
+# so only the property dicts can be built once
+HEADER_FORMAT = {"bold": True}
+TS_FORMAT = {"num_format": "yyyy-mm-dd hh:mm:ss"}
+
+def _build_xlsx(user_id: int, period: str) -> str:
+    """Write the export workbook to a temp file and return its path (runs off the event loop)."""
+    # constant_memory needs a real file: xlsxwriter streams sheet rows to disk while building,
+    # so no row grid or BytesIO copy is held (InputFile still reads the file for the upload)
+    with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as tmp:
+        path = tmp.name
+    # a private connection: under WAL this thread reads its own consistent snapshot,
+    # streaming rows from the cursor, while the event loop keeps writing through DB
+    conn = _connect()
+    try:
+        # constant_memory flushes each row as XML as soon as the next one starts;
+        # user text is written verbatim, never as a formula or hyperlink.
+        # The with block closes the workbook on failure too, releasing the per-sheet temp files.
+        with xlsxwriter.Workbook(path, {
+            "constant_memory": True,
+            "strings_to_formulas": False,
+            "strings_to_urls": False,
+        }) as wb:
+            ws = wb.add_worksheet("Expenses")
+            # timestamps go in as Excel serial days and the column format renders them,
+            # so no per-row datetime/strftime work
+            ws.set_column(1, 1, 19, wb.add_format(TS_FORMAT))
+            ws.write_row(0, 0, EXPORT_HEADER, wb.add_format(HEADER_FORMAT))
+            write_row = ws.write_row
+            for row, (ts, amount, category, notes) in enumerate(get_expenses(conn, user_id, period), 1):
+                write_row(row, 0, (period, ts / 86400 + EXCEL_EPOCH_DAYS, float(amount), category, notes))
+    except Exception:
+        os.unlink(path)
+        raise
+    finally:
+        conn.close()
+    return path
+
 async def exportexcel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        from openpyxl import Workbook
         user_id = update.effective_user.id
-        items = get_current_month_expenses(user_id)
-        if not items:
+        period = _ensure_user_period(user_id)
+        version = VERSION.get(user_id, 0)
+        cached = EXPORT_CACHE.get(user_id)
+        if cached and cached[:2] == (period, version):
+            # nothing changed since the last export: Telegram already has the file,
+            # so send it by file_id instead of rebuilding and re-uploading it
+            EXPORT_CACHE[user_id] = EXPORT_CACHE.pop(user_id)   # mark most recently used
+            return await update.message.reply_document(cached[2], caption="✅ Full export (free).")
+
+        if not _period_totals(user_id, period).cats:
             return await update.message.reply_text("No expenses yet.")
+        # the row scan, XML serialization and zip compression all stay off the event loop
+        path = await asyncio.to_thread(_build_xlsx, user_id, period)
+        try:
+            with open(path, "rb") as fh:
+                sent = await update.message.reply_document(InputFile(fh, "budget_full.xlsx"),
+                                                           caption="✅ Full export (free).")
+        finally:
+            os.unlink(path)
+        EXPORT_CACHE.pop(user_id, None)
+        EXPORT_CACHE[user_id] = (period, version, sent.document.file_id)
+        if len(EXPORT_CACHE) > EXPORT_CACHE_MAX:
+            del EXPORT_CACHE[next(iter(EXPORT_CACHE))]
+    except Exception as e:
+        await update.message.reply_text(f"❌ export error: {e}")
+
+FORMULA_START = ("=", "+", "-", "@")
+
+def _csv_text(value: str) -> str:
+    # Excel evaluates a CSV cell starting with these as a formula; a leading "'" keeps it
+    # text, matching strings_to_formulas=False in the xlsx export
+    return "'" + value if value.startswith(FORMULA_START) else value
+
+@lru_cache(maxsize=4096)
+def _fmt_ts(ts: int) -> str:
+    # rows added in one paste share a timestamp, so most rows are cache hits
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
 
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Expenses"
-        ws.append(["Period", "Timestamp (UTC)", "Amount", "Category", "Notes"])
-        period = CURRENT_PERIOD[user_id]
-        for x in items:
-            ws.append([period, x["ts"].strftime("%Y-%m-%d %H:%M:%S"),
-                       float(x["amount"]), x["category"], x["notes"]])
-
-        bio = io.BytesIO()
-        wb.save(bio)
-        bio.seek(0)
-        await update.message.reply_document(InputFile(bio, "budget_full.xlsx"),
-                                            caption="✅ Full export (free).")
+def _build_csv(user_id: int, period: str) -> str:
+    """Write the export as CSV to a temp file and return its path (runs off the event loop)."""
+    with tempfile.NamedTemporaryFile(suffix=".csv", delete=False) as tmp:
+        path = tmp.name
+    conn = _connect()
+    try:
+        # utf-8-sig so Excel detects the encoding; newline="" leaves line endings to csv
+        with open(path, "w", encoding="utf-8-sig", newline="") as fh:
+            out = csv.writer(fh)
+            out.writerow(EXPORT_HEADER)
+            out.writerows(
+                (period, _fmt_ts(ts), amount, _csv_text(category), _csv_text(notes))
+                for ts, amount, category, notes in get_expenses(conn, user_id, period)
+            )
+    except Exception:
+        os.unlink(path)
+        raise
+    finally:
+        conn.close()
+    return path
+
+async def exportcsv(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        user_id = update.effective_user.id
+        period = _ensure_user_period(user_id)
+        if not _period_totals(user_id, period).cats:
+            return await update.message.reply_text("No expenses yet.")
+        path = await asyncio.to_thread(_build_csv, user_id, period)
+        try:
+            with open(path, "rb") as fh:
+                await update.message.reply_document(InputFile(fh, "budget_full.csv"),
+                                                    caption="✅ Full export (CSV).")
+        finally:
+            os.unlink(path)
     except Exception as e:
         await update.message.reply_text(f"❌ export error: {e}")
 
 # =============== Fallback Text ===============
+async def _new_month(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    clear_current_month(user_id)
+    set_mode(user_id, "add")
+    await update.message.reply_text("✅ New month started. Paste expenses or type **done**.")
+
+async def _done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    set_mode(update.effective_user.id, None)
+    await update.message.reply_text("Okay. You can type **view**, **generate**, or **export** anytime.")
+
+# exact (lowercased) keyword -> handler
+ROUTES = {
+    "hi": start, "hello": start, "hey": start, "start": start, "go": start,
+    "reset": _new_month, "new month": _new_month, "start new month": _new_month, "clear": _new_month,
+    "view": viewexpenses, "summary": viewexpenses,
+    "generate": generatebudget, "budget": generatebudget,
+    "export": exportexcel, "excel": exportexcel,
+    "csv": exportcsv, "export csv": exportcsv,
+    "done": _done, "stop": _done, "finish": _done,
+}
+ADD_RE = re.compile(r"add\s+(.*)", re.IGNORECASE | re.DOTALL)
+AMOUNT_START = frozenset("0123456789$.,-+")   # no keyword starts with these
+
+async def _add_mode(update: Update, user_id: int, block: str):
+    """Add-mode: handle multi-line and/or slashes in one go."""
+    items, errors = parse_expense_block(block)
+    if items:
+        add_expenses_to_store(user_id, items)
+        return await update.message.reply_text(_format_add_result(len(items), errors))
+
+    return await update.message.reply_text(_nothing_added_reply(
+        "Send expenses like:\n"
+        "• 1200 rent\n• 500 food\n• 200 insurance\n"
+        "or in one line: 1200 rent / 500 food / 200 insurance",
+        errors,
+    ))
+
 async def fallback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text_raw = update.message.text or ""
-    text = text_raw.strip().lower()
+    text_raw = (update.message.text or "").strip()
     user_id = update.effective_user.id
 
+    # expense lines are the most common message in add-mode and can't be keywords:
+    # parse them straight away, without building the lowercased copy
+    if MODE.get(user_id) == "add" and text_raw[:1] in AMOUNT_START:
+        return await _add_mode(update, user_id, text_raw)
+
+    text = text_raw.lower()
+
     # quick commands
-    if text in ["reset", "new month", "start new month", "clear"]:
-        clear_current_month(user_id)
-        MODE[user_id] = "add"
-        return await update.message.reply_text("✅ New month started. Paste expenses or type **done**.")
-    if text in ["view", "summary"]:
-        return await viewexpenses(update, context)
-    if text in ["generate", "budget"]:
-        return await generatebudget(update, context)
-    if text in ["export", "excel"]:
-        return await exportexcel(update, context)
+    handler = ROUTES.get(text)
+    if handler is not None:
+        return await handler(update, context)
 
     # "add ..." with block support (slashes or newlines)
-    if text.startswith("add "):
-        content = text_raw[4:]
-        items, errors = parse_expense_block(content)
+    add_match = ADD_RE.match(text_raw)
+    if add_match:
+        items, errors = parse_expense_block(add_match.group(1))
         if items:
-            for amt, cat, notes in items:
-                add_expense_to_store(user_id, amt, cat, notes)
-            msg = f"✅ Added {len(items)} item(s)."
-            if errors:
-                msg += f"\n⚠️ Skipped {len(errors)} line(s):\n- " + "\n- ".join(errors[:5])
-                if len(errors) > 5:
-                    msg += f"\n(and {len(errors)-5} more...)"
-            return await update.message.reply_text(msg)
-        return await update.message.reply_text("Usage:\nadd 1200 rent / 500 food / 200 insurance")
-
-    # Add-mode: handle multi-line and/or slashes in one go
-    if MODE.get(user_id) == "add":
-        block = text_raw.strip()
-        items, errors = parse_expense_block(block)
-        if items:
-            for amt, cat, notes in items:
-                add_expense_to_store(user_id, amt, cat, notes)
-            msg = f"✅ Added {len(items)} item(s)."
-            if errors:
-                msg += f"\n⚠️ Skipped {len(errors)} line(s):\n- " + "\n- ".join(errors[:5])
-                if len(errors) > 5:
-                    msg += f"\n(and {len(errors)-5} more...)"
-            return await update.message.reply_text(msg)
-
+            add_expenses_to_store(user_id, items)
+            return await update.message.reply_text(_format_add_result(len(items), errors))
         return await update.message.reply_text(
-            "Send expenses like:\n"
-            "• 1200 rent\n• 500 food\n• 200 insurance\n"
-            "or in one line: 1200 rent / 500 food / 200 insurance"
+            _nothing_added_reply("Usage:\nadd 1200 rent / 500 food / 200 insurance", errors)
         )
 
-    if text in ["done", "stop", "finish"]:
-        MODE[user_id] = None
-        return await update.message.reply_text("Okay. You can type **view**, **generate**, or **export** anytime.")
+    if MODE.get(user_id) == "add":
+        return await _add_mode(update, user_id, text_raw)
 
     return await update.message.reply_text(
         "Try: **hi** to start, `add 1200 rent`, paste multiple lines or use slashes, **view**, **generate**, **export**."
     )
 
+# =============== Per-user ordering ===============
+# Each user's updates run one at a time, in arrival order (MODE/CURRENT_PERIOD rely on it),
+# while different users' queues drain concurrently.
+_USER_QUEUES = {}         # user_id -> asyncio.Queue of (handler, update, context)
+_USER_TASKS = {}          # user_id -> task draining that queue
+
+async def _drain(user_id: int):
+    queue = _USER_QUEUES[user_id]
+    try:
+        while not queue.empty():
+            handler, update, context = queue.get_nowait()
+            try:
+                await handler(update, context)
+            except Exception:
+                logger.exception("%s failed for user %s", handler.__name__, user_id)
+    finally:
+        # no await between the empty() check and here, so nothing can be enqueued in between
+        del _USER_QUEUES[user_id]
+        del _USER_TASKS[user_id]
+
+def per_user(handler):
+    async def enqueue(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user_id = update.effective_user.id
+        queue = _USER_QUEUES.get(user_id)
+        if queue is None:
+            queue = _USER_QUEUES[user_id] = asyncio.Queue()
+        queue.put_nowait((handler, update, context))
+        if user_id not in _USER_TASKS:
+            _USER_TASKS[user_id] = context.application.create_task(_drain(user_id))
+    return enqueue
+
 # =============== Main ===============
 def main():
     if not TOKEN:
         raise SystemExit("BOT_TOKEN not set.")
+    if uvloop is not None:
+        # must be set before PTB creates its loop in run_webhook/run_polling
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
-    app = Application.builder().token(TOKEN).build()
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("help", help_cmd))
-    app.add_handler(CommandHandler("reset", reset_cmd))
-    app.add_handler(CommandHandler("addexpense", addexpense))
-    app.add_handler(CommandHandler("addmany", addmany))
-    app.add_handler(CommandHandler("viewexpenses", viewexpenses))
-    app.add_handler(CommandHandler("generatebudget", generatebudget))
-    app.add_handler(CommandHandler("exportexcel", exportexcel))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, fallback))
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    # AIORateLimiter throttles outgoing calls to Telegram's limits (~30 msg/s overall,
+    # 20/min per group) so bursts queue locally instead of coming back as 429s
+    app = Application.builder().token(TOKEN).rate_limiter(AIORateLimiter()).build()
+    app.add_handler(CommandHandler("start", per_user(start)))
+    app.add_handler(CommandHandler("help", per_user(help_cmd)))
+    app.add_handler(CommandHandler("reset", per_user(reset_cmd)))
+    app.add_handler(CommandHandler("addexpense", per_user(addexpense)))
+    app.add_handler(CommandHandler("addmany", per_user(addmany)))
+    app.add_handler(CommandHandler("viewexpenses", per_user(viewexpenses)))
+    app.add_handler(CommandHandler("generatebudget", per_user(generatebudget)))
+    app.add_handler(CommandHandler("exportexcel", per_user(exportexcel)))
+    app.add_handler(CommandHandler("exportcsv", per_user(exportcsv)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, per_user(fallback)))
+    if WEBHOOK_URL:
+        # Telegram pushes updates to us; nothing runs between messages.
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{TOKEN}",
+            allowed_updates=Update.ALL_TYPES,
+            # Telegram echoes this in X-Telegram-Bot-Api-Secret-Token; PTB rejects requests without it
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,245 @@
+import calendar
+import os
+import time
+import unittest
+from unittest import mock
+import zipfile
+from types import SimpleNamespace
+
+os.environ.setdefault("DB_PATH", ":memory:")
+
+import bot
+
+
+class FakeMessage:
+    """Stands in for telegram.Message: records what the handler replied."""
+
+    def __init__(self, text=""):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+    async def reply_document(self, document, **kwargs):
+        self.replies.append(document)
+        return SimpleNamespace(document=SimpleNamespace(file_id=f"file-{len(self.replies)}"))
+
+
+def fake_update(user_id, text=""):
+    return SimpleNamespace(message=FakeMessage(text), effective_user=SimpleNamespace(id=user_id))
+
+
+def per_call_seconds(func, arg, repeat):
+    """Best-of-3 average time of func(arg), so one slow scheduler tick doesn't count."""
+    best = float("inf")
+    for _ in range(3):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            func(arg)
+        best = min(best, (time.perf_counter() - started) / repeat)
+    return best
+
+
+class ParseFreeExpenseTest(unittest.TestCase):
+    def test_long_whitespace_run_parses_in_linear_time(self):
+        # 8x the whitespace: linear parsing costs ~4-8x, the old quadratic pattern ~60x
+        short = per_call_seconds(bot.parse_free_expense, "1 rent x" + " " * 2000 + "y", 40)
+        long = per_call_seconds(bot.parse_free_expense, "1 rent x" + " " * 16000 + "y", 5)
+        self.assertLess(long / short, 20)
+
+        amount, category, notes = bot.parse_free_expense("1 rent x" + " " * 63000 + "y")
+        self.assertEqual((amount, category, notes), (1.0, "rent", "x y"))
+
+    def test_trailing_whitespace_is_not_kept_in_notes(self):
+        self.assertEqual(bot.parse_free_expense("50 food milk   "), (50.0, "food", "milk"))
+
+    def test_notes_whitespace_collapses(self):
+        self.assertEqual(bot.parse_free_expense("50 food  oat \t milk"), (50.0, "food", "oat milk"))
+
+    def test_amount_forms_accepted_by_float(self):
+        cases = {
+            "-20 refund": (-20.0, "refund", ""),
+            "1e3 x": (1000.0, "x", ""),
+            "50$ food": (50.0, "food", ""),
+            "$$50 x": (50.0, "x", ""),
+            ",50 x": (50.0, "x", ""),
+            "$1,200 for the rent": (1200.0, "rent", ""),
+        }
+        for line, expected in cases.items():
+            with self.subTest(line=line):
+                self.assertEqual(bot.parse_free_expense(line), expected)
+
+    def test_rejects_non_numeric_and_non_finite_amounts(self):
+        for line in ("50rent", "abc 5", "nan x", "inf x", "1e400 x", "   "):
+            with self.subTest(line=line):
+                self.assertIsNone(bot.parse_free_expense(line))
+
+
+class ParseExpenseBlockTest(unittest.TestCase):
+    def test_lines_past_the_limit_are_reported_as_one_entry(self):
+        items, errors = bot.parse_expense_block("1 x\n" * (bot.MAX_BLOCK_LINES + 3))
+        self.assertEqual(len(items), bot.MAX_BLOCK_LINES)
+        self.assertEqual(errors, [f"<3 line(s) past the {bot.MAX_BLOCK_LINES}-line limit>"])
+        self.assertTrue(bot.LIMIT_ERROR_RE.fullmatch(errors[-1]))
+
+
+class NothingAddedReplyTest(unittest.TestCase):
+    def test_size_limit_is_reported_without_a_success_mark(self):
+        _, errors = bot.parse_expense_block("1 x\n" * (bot.MAX_BLOCK_CHARS // 4 + 1))
+        reply = bot._nothing_added_reply("usage", errors)
+        self.assertEqual(reply, "⚠️ Nothing added: <input too large>\n\nusage")
+
+    def test_chat_lines_get_only_the_usage_hint(self):
+        _, errors = bot.parse_expense_block("thanks!")
+        self.assertEqual(bot._nothing_added_reply("usage", errors), "usage")
+
+
+class AddExpenseCommandTest(unittest.IsolatedAsyncioTestCase):
+    async def test_non_finite_amounts_are_refused_and_not_stored(self):
+        for amount in ("nan", "inf", "1e400", "abc"):
+            with self.subTest(amount=amount):
+                message = FakeMessage()
+                update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=4242))
+                await bot.addexpense(update, SimpleNamespace(args=[amount, "food"]))
+                self.assertEqual(message.replies, ["Amount must be a number."])
+        self.assertEqual(bot.get_current_month_summary(4242)[0], 0.0)
+
+
+class RunningTotalsTest(unittest.TestCase):
+    user_id = 6161
+
+    def setUp(self):
+        bot.clear_current_month(self.user_id)
+        self.period = bot._ensure_user_period(self.user_id)
+
+    def _sql_totals(self):
+        return dict(bot.DB.execute(
+            "SELECT category, SUM(amount) FROM expenses WHERE user_id = ? AND period = ? GROUP BY category",
+            (self.user_id, self.period),
+        ))
+
+    def _running_totals(self):
+        return dict(bot._period_totals(self.user_id, self.period).items())
+
+    def test_running_totals_match_group_by(self):
+        bot.add_expenses_to_store(self.user_id, [(1200.0, "rent", ""), (50.5, "food", ""), (-20.0, "food", "")])
+        bot.add_expense_to_store(self.user_id, 9.99, "gas", "")
+        self.assertEqual(self._running_totals(), self._sql_totals())
+        self.assertEqual(self._running_totals(), {"rent": 1200.0, "food": 30.5, "gas": 9.99})
+
+    def test_totals_reseeded_from_sqlite_match(self):
+        bot.add_expenses_to_store(self.user_id, [(5.0, "a", ""), (7.0, "b", ""), (1.0, "a", "")])
+        del bot.TOTALS[self.user_id, self.period]   # as after a restart
+        self.assertEqual(self._running_totals(), {"a": 6.0, "b": 7.0})
+
+    def test_clear_current_month_resets_both(self):
+        bot.add_expenses_to_store(self.user_id, [(5.0, "a", "")])
+        bot.clear_current_month(self.user_id)
+        self.assertEqual(self._running_totals(), {})
+        self.assertEqual(self._sql_totals(), {})
+        bot.add_expenses_to_store(self.user_id, [(3.0, "b", "")])
+        self.assertEqual(self._running_totals(), self._sql_totals())
+
+
+class CacheInvalidationTest(unittest.IsolatedAsyncioTestCase):
+    user_id = 7171
+
+    def setUp(self):
+        bot.clear_current_month(self.user_id)
+        bot.add_expenses_to_store(self.user_id, [(10.0, "food", "")])
+
+    def test_summary_is_rerendered_only_after_a_change(self):
+        render = mock.Mock(side_effect=bot._render_view)
+        first = bot._cached_summary("view", self.user_id, render)
+        self.assertIs(bot._cached_summary("view", self.user_id, render), first)
+        self.assertEqual(render.call_count, 1)
+
+        bot.add_expenses_to_store(self.user_id, [(5.0, "food", "")])
+        self.assertIn("$15.00", bot._cached_summary("view", self.user_id, render))
+        bot.clear_current_month(self.user_id)
+        self.assertEqual(bot._cached_summary("view", self.user_id, render), "No expenses yet.")
+        self.assertEqual(render.call_count, 3)
+
+    async def test_export_is_resent_by_file_id_until_a_change(self):
+        async def export():
+            update = fake_update(self.user_id)
+            await bot.exportexcel(update, None)
+            return update.message.replies[0]
+
+        self.assertIsInstance(await export(), bot.InputFile)
+        cached_id = bot.EXPORT_CACHE[self.user_id][2]
+        self.assertEqual(await export(), cached_id)
+
+        bot.add_expenses_to_store(self.user_id, [(5.0, "gas", "")])
+        self.assertIsInstance(await export(), bot.InputFile)
+
+
+class ThisMonthTest(unittest.TestCase):
+    def setUp(self):
+        bot._MONTH_CACHE[:] = [0.0, ""]
+        self.addCleanup(bot._MONTH_CACHE.__setitem__, slice(None), [0.0, ""])
+
+    def _this_month_at(self, timestamp):
+        with mock.patch("bot.time.time", return_value=timestamp):
+            return bot._this_month()
+
+    def test_rolls_over_at_the_new_year(self):
+        new_year = calendar.timegm((2027, 1, 1, 0, 0, 0))
+        self.assertEqual(self._this_month_at(new_year - 1), "2026-12")
+        self.assertEqual(bot._MONTH_CACHE[0], new_year)
+        self.assertEqual(self._this_month_at(new_year), "2027-01")
+        self.assertEqual(bot._MONTH_CACHE[0], calendar.timegm((2027, 2, 1, 0, 0, 0)))
+
+    def test_cached_within_the_month(self):
+        mid_month = calendar.timegm((2026, 12, 15, 12, 0, 0))
+        self.assertEqual(self._this_month_at(mid_month), "2026-12")
+        with mock.patch("bot.time.gmtime") as gmtime:
+            self.assertEqual(self._this_month_at(mid_month + 86400), "2026-12")
+        gmtime.assert_not_called()
+
+
+class ExportBuildTest(unittest.TestCase):
+    user_id = 5151
+
+    def setUp(self):
+        bot.clear_current_month(self.user_id)
+        bot.add_expenses_to_store(self.user_id, [(1200.0, "rent", "june"), (-20.0, "refund", "=1+1")])
+        self.period = bot._ensure_user_period(self.user_id)
+
+    def _build(self, builder):
+        path = builder(self.user_id, self.period)
+        self.addCleanup(os.unlink, path)
+        return path
+
+    def test_csv_has_header_and_rows(self):
+        with open(self._build(bot._build_csv), encoding="utf-8-sig") as fh:
+            lines = fh.read().splitlines()
+        self.assertEqual(lines[0], ",".join(bot.EXPORT_HEADER))
+        self.assertEqual(len(lines), 3)
+        self.assertIn(",1200.0,rent,june", lines[1])
+        self.assertIn(",-20.0,refund,'=1+1", lines[2])
+
+    def test_xlsx_has_header_and_rows(self):
+        with zipfile.ZipFile(self._build(bot._build_xlsx)) as zf:
+            sheet = zf.read("xl/worksheets/sheet1.xml").decode()
+        self.assertEqual(sheet.count("<row "), 3)
+        for text in ("Timestamp (UTC)", "rent", "june", "refund", "=1+1"):
+            self.assertIn(text, sheet)
+        self.assertNotIn("<f>", sheet)
+
+
+class CsvTextTest(unittest.TestCase):
+    def test_formula_like_text_is_quoted(self):
+        for value in ("=HYPERLINK(\"x\")", "+1", "-2+3", "@SUM(A1)"):
+            with self.subTest(value=value):
+                self.assertEqual(bot._csv_text(value), "'" + value)
+
+    def test_plain_text_is_unchanged(self):
+        for value in ("rent", "", "a=b"):
+            with self.subTest(value=value):
+                self.assertEqual(bot._csv_text(value), value)
+
+
+if __name__ == "__main__":
+    unittest.main()